@@ -0,0 +1,208 @@
+"""Minimal client for the local ADB server's socket protocol.
+
+Talks to the adb server on 127.0.0.1:5037 directly instead of forking the
+adb CLI for every command. The server keeps the TCP transport to each
+device open, so each request here is a localhost socket round trip.
+"""
+import re
+import socket
+import threading
+
+ADB_HOST = '127.0.0.1'
+ADB_PORT = 5037
+
+RC_MARKER = '__ADB_RC__'
+END_MARKER = '__END__'
+_END_RE = re.compile(rb'__END__(\d+)\r?\n')
+
+
+class AdbError(Exception):
+    """ADB server answered FAIL"""
+
+
+class ShellEchoError(AdbError):
+    """The interactive shell echoes its input, so output cannot be told apart from commands"""
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise AdbError("Connection closed by ADB server")
+        data += chunk
+    return data
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def _send(sock, payload):
+    """Send one length-prefixed request"""
+    data = payload.encode('utf-8')
+    sock.sendall(b'%04x' % len(data) + data)
+
+
+def _read_status(sock):
+    """Read the OKAY/FAIL answer to a request"""
+    status = _recv_exact(sock, 4)
+    if status == b'OKAY':
+        return
+    if status == b'FAIL':
+        raise AdbError(_read_string(sock).decode('utf-8', 'replace'))
+    raise AdbError(f"Unexpected ADB server reply: {status!r}")
+
+
+def _read_string(sock):
+    length = int(_recv_exact(sock, 4), 16)
+    return _recv_exact(sock, length)
+
+
+def open_server(timeout=10):
+    """Open a socket to the local ADB server"""
+    return socket.create_connection((ADB_HOST, ADB_PORT), timeout=timeout)
+
+
+def host_command(payload, timeout=10):
+    """Run a host service (host:connect:<ip>, host-serial:<ip>:get-state, ...)
+
+    The reply is returned as raw bytes; callers only test it for markers.
+    """
+    with open_server(timeout) as sock:
+        _send(sock, payload)
+        _read_status(sock)
+        return _read_string(sock)
+
+
+def connect(serial, timeout=12):
+    return host_command(f'host:connect:{serial}', timeout)
+
+
+def disconnect(serial, timeout=5):
+    return host_command(f'host:disconnect:{serial}', timeout)
+
+
+def get_state(serial, timeout=2):
+    """b'device', b'offline', ... (AdbError when the server does not know it)"""
+    return host_command(f'host-serial:{serial}:get-state', timeout)
+
+
+def wait_for_device(serial, timeout=10):
+    """Block until the server reports `serial` in the device state
+
+    The server acknowledges wait-for-any-device straight away and sends a
+    second OKAY once the transport is ready, so this returns on that event
+    instead of polling get-state. socket.timeout bounds the wait.
+    """
+    with open_server(timeout) as sock:
+        _send(sock, f'host-serial:{serial}:wait-for-any-device')
+        _read_status(sock)
+        _read_status(sock)
+
+
+def open_service(serial, service, timeout=10):
+    """Open a device service stream (shell:..., sync:, ...) on `serial`
+
+    The service request is only sent once host:transport has been
+    acknowledged: the server discards anything that arrived in the same
+    read as the transport switch, so a pipelined request would be lost.
+    """
+    sock = open_server(timeout)
+    try:
+        _send(sock, f'host:transport:{serial}')
+        _read_status(sock)
+        _send(sock, service)
+        _read_status(sock)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def shell(serial, command, timeout=10):
+    """Run a shell command on a device, returns (output, returncode)
+
+    The shell: service does not report an exit status, so the command is
+    followed by an echo of $? that is stripped from the output.
+    """
+    with open_service(serial, f'shell:{command}; echo {RC_MARKER}$?', timeout) as sock:
+        output = _recv_all(sock).decode('utf-8', 'replace').replace('\r\n', '\n')
+
+    output, _, rc = output.rpartition(RC_MARKER)
+    try:
+        return output, int(rc.strip())
+    except ValueError:
+        return output + rc, 1
+
+
+class PersistentShell:
+    """Long-lived shell stream to one device
+
+    Commands are written to the same remote shell and framed with an
+    `echo __END__$?` sentinel, so each one costs a pipe write instead of a
+    new adb stream. A session that times out is closed, since its output
+    can no longer be matched to a command.
+    """
+
+    def __init__(self, serial, timeout=10):
+        self.serial = serial
+        self.lock = threading.Lock()
+        self._buffer = b''
+        try:
+            # No pty: nothing echoes the commands back or prints prompts
+            self.sock = open_service(serial, 'shell,raw:', timeout)
+        except AdbError:
+            # adbd without shell v2 only knows shell:, which always gets a pty
+            self.sock = open_service(serial, 'shell:', timeout)
+            self._disable_echo(timeout)
+
+    def _disable_echo(self, timeout):
+        """Turn off the pty's echo and prompts, ShellEchoError if it stays on"""
+        try:
+            # Sent as is: inside run()'s </dev/null stty would act on /dev/null.
+            # The echoed copy shows a literal $? and is dropped with the prompt.
+            self._exchange(f'stty -echo 2>/dev/null; PS1=; PS2=; echo {END_MARKER}$?\n', timeout)
+            # Without stty the typed commands would come back in the output
+            output, _ = self.run(': __ECHO_PROBE__', timeout)
+            if '__ECHO_PROBE__' in output:
+                raise ShellEchoError(f"Shell on {self.serial} echoes input")
+        except Exception:
+            self.close()
+            raise
+
+    def run(self, command, timeout=10):
+        """Run one command, returns (output, returncode)"""
+        return self._exchange(f'{{ {command}\n}} </dev/null 2>&1; echo {END_MARKER}$?\n', timeout)
+
+    def _exchange(self, line, timeout):
+        """Write `line` and read up to the sentinel it ends with"""
+        with self.lock:
+            try:
+                self.sock.settimeout(timeout)
+                self.sock.sendall(line.encode('utf-8'))
+                while True:
+                    match = _END_RE.search(self._buffer)
+                    if match:
+                        break
+                    chunk = self.sock.recv(65536)
+                    if not chunk:
+                        raise AdbError("Shell session closed by device")
+                    self._buffer += chunk
+            except Exception:
+                self.close()
+                raise
+            output = self._buffer[:match.start()]
+            self._buffer = self._buffer[match.end():]
+        return output.decode('utf-8', 'replace').replace('\r\n', '\n'), int(match.group(1))
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
@@ -0,0 +1,107 @@
+"""Minimal reader for the binary AndroidManifest.xml inside an APK.
+
+Only pulls the package name and versionCode from the <manifest> element,
+which is all the installer needs to tell whether a device is already
+current. Avoids depending on aapt or androguard for two attributes.
+"""
+import struct
+import zipfile
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+
+UTF8_FLAG = 0x100
+NO_INDEX = 0xFFFFFFFF
+
+# android:versionCode, matched by id too since shrunk APKs may strip attribute names
+VERSION_CODE_RES_ID = 0x0101021b
+
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+
+
+def _string_length(data, offset, utf8):
+    """Decode a pool string's length prefix, returns (length, next offset)"""
+    if utf8:
+        length = data[offset]
+        if length & 0x80:
+            return ((length & 0x7F) << 8) | data[offset + 1], offset + 2
+        return length, offset + 1
+    length = struct.unpack_from('<H', data, offset)[0]
+    if length & 0x8000:
+        return ((length & 0x7FFF) << 16) | struct.unpack_from('<H', data, offset + 2)[0], offset + 4
+    return length, offset + 2
+
+
+def _string_pool(data, start):
+    _, header_size, _, count, _, flags, strings_start, _ = struct.unpack_from('<HHIIIIII', data, start)
+    utf8 = bool(flags & UTF8_FLAG)
+    offsets = struct.unpack_from(f'<{count}I', data, start + header_size)
+    strings = []
+    for offset in offsets:
+        pos = start + strings_start + offset
+        if utf8:
+            # UTF-16 length first, then the UTF-8 byte length actually used
+            _, pos = _string_length(data, pos, True)
+            length, pos = _string_length(data, pos, True)
+            strings.append(data[pos:pos + length].decode('utf-8', 'replace'))
+        else:
+            length, pos = _string_length(data, pos, False)
+            strings.append(data[pos:pos + length * 2].decode('utf-16-le', 'replace'))
+    return strings
+
+
+def parse_manifest(data):
+    """(package, versionCode) from binary AndroidManifest.xml bytes
+
+    Raises ValueError when the data is not a binary manifest or has no
+    <manifest> element.
+    """
+    try:
+        return _parse(data)
+    except (struct.error, IndexError, UnicodeError) as e:
+        raise ValueError(f"Malformed AndroidManifest.xml: {e}")
+
+
+def _parse(data):
+    if len(data) < 8 or struct.unpack_from('<H', data, 0)[0] != RES_XML_TYPE:
+        raise ValueError("AndroidManifest.xml is not a binary XML file")
+    strings = []
+    resource_ids = ()
+    pos = struct.unpack_from('<H', data, 2)[0]
+    while pos + 8 <= len(data):
+        chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', data, pos)
+        if chunk_size < 8:
+            break
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = _string_pool(data, pos)
+        elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+            resource_ids = struct.unpack_from(f'<{(chunk_size - header_size) // 4}I', data, pos + header_size)
+        elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+            ext = pos + header_size
+            _, name, attr_start, attr_size, attr_count = struct.unpack_from('<IIHHH', data, ext)
+            if strings[name] == 'manifest':
+                package = version_code = None
+                for i in range(attr_count):
+                    attr = ext + attr_start + i * attr_size
+                    _, attr_name, raw_value, _, _, data_type, value = struct.unpack_from('<IIIHBBI', data, attr)
+                    attr_id = resource_ids[attr_name] if attr_name < len(resource_ids) else None
+                    if strings[attr_name] == 'package' and raw_value != NO_INDEX:
+                        package = strings[raw_value]
+                    elif strings[attr_name] == 'versionCode' or attr_id == VERSION_CODE_RES_ID:
+                        if data_type in (TYPE_INT_DEC, TYPE_INT_HEX):
+                            version_code = value
+                        elif data_type == TYPE_STRING and raw_value != NO_INDEX:
+                            version_code = int(strings[raw_value])
+                return package, version_code
+        pos += chunk_size
+    raise ValueError("AndroidManifest.xml has no <manifest> element")
+
+
+def read_manifest(apk_path):
+    """(package, versionCode) of an APK file"""
+    with zipfile.ZipFile(apk_path) as apk:
+        return parse_manifest(apk.read('AndroidManifest.xml'))
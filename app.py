@@ -1,100 +1,535 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
 import subprocess
+import select
+import socket
 import threading
 import time
 import csv
+import io
 import os
+import stat
+import hashlib
+import json
+import queue
+import re
+import zipfile
+from dataclasses import dataclass, field
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
 from functools import lru_cache
 
+import adb_proto
+import apk_manifest
+
 app = Flask(__name__)
 
-installation_progress = {
-    'status': 'idle',
-    'total_devices': 0,
-    'completed': 0,
-    'success': 0,
-    'failed': 0,
-    'results': [],
-    'log_file': None
-}
+def format_result(result):
+    """Result tuple with its time_ns timestamp formatted for output"""
+    return (datetime.fromtimestamp(result[0] / 1e9).isoformat(timespec='milliseconds'),) + tuple(result[1:])
+
+@dataclass
+class Progress:
+    """State of the current installation run, shared by the runner and the routes
+
+    Every read and write goes through the methods below, under one lock, so
+    counters never lose updates and snapshots never catch a half-recorded result.
+    """
+    status: str = 'idle'
+    total_devices: int = 0
+    completed: int = 0
+    success: int = 0
+    failed: int = 0
+    results: list = field(default_factory=list)
+    log_file: str = None
+    # Bumped on every change so /progress can answer 304 Not Modified; the epoch
+    # keeps ETags from a previous server process from matching
+    version: int = 0
+    epoch: str = field(default_factory=lambda: os.urandom(4).hex())
+    # One queue per open /progress_stream client
+    subscribers: list = field(default_factory=list, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    
+    def _counters(self):
+        return {'status': self.status, 'total_devices': self.total_devices, 'completed': self.completed,
+                'success': self.success, 'failed': self.failed}
+    
+    def _snapshot(self):
+        return dict(self._counters(), results=list(self.results), log_file=self.log_file)
+    
+    def _publish(self, result=None):
+        """Bump the version and push the delta to every stream client (lock held)"""
+        self.version += 1
+        delta = self._counters()
+        if result is not None:
+            delta['result'] = result
+        for events in self.subscribers:
+            events.put(delta)
+    
+    def etag(self):
+        with self.lock:
+            return f"{self.epoch}-{self.version}"
+    
+    def snapshot(self):
+        """(etag, dict) taken together"""
+        with self.lock:
+            return f"{self.epoch}-{self.version}", self._snapshot()
+    
+    def results_since(self, index, limit):
+        """(etag, dict) with the counters and at most `limit` results from `index` on"""
+        with self.lock:
+            index = min(index, len(self.results))
+            new_results = self.results[index:index + limit]
+            return f"{self.epoch}-{self.version}", dict(self._counters(), log_file=self.log_file,
+                                                        new_results=new_results,
+                                                        next_index=index + len(new_results))
+    
+    def start(self, total_devices, log_file):
+        """Reset for a new run, False if one is already running"""
+        with self.lock:
+            if self.status == 'running':
+                return False
+            self.status = 'running'
+            self.total_devices = total_devices
+            self.completed = self.success = self.failed = 0
+            self.results = []
+            self.log_file = log_file
+            self._publish()
+            return True
+    
+    def record(self, result):
+        """Count one finished device, returns how many are done"""
+        # Clients get the timestamp as text, like the CSV, not the raw time_ns
+        result = format_result(result)
+        with self.lock:
+            self.results.append(result)
+            self.completed += 1
+            # A device skipped for already running this build counts as done
+            if result[2] in ("SUCCESS", "SKIPPED"):
+                self.success += 1
+            else:
+                self.failed += 1
+            self._publish(result)
+            return self.completed
+    
+    def record_error(self):
+        """Count a device whose worker raised instead of returning a result"""
+        with self.lock:
+            self.completed += 1
+            self.failed += 1
+            self._publish()
+    
+    def finish(self):
+        with self.lock:
+            self.status = 'completed'
+            self._publish()
+    
+    def subscribe(self):
+        """New event queue for a stream client, with the snapshot it starts from"""
+        events = queue.Queue()
+        with self.lock:
+            self.subscribers.append(events)
+            return events, self._snapshot()
+    
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.remove(events)
+
+progress = Progress()
+# Most results one /progress?since= response carries; the client asks again for the rest
+PROGRESS_RESULTS_LIMIT = 500
+
+LOG_HEADER = ["Timestamp", "Device", "Status", "Details", "UninstallVerified", "InstallVerified", "LaunchStatus"]
+
+# Install log rows buffered between flushes
+LOG_FLUSH_ROWS = 8
 
-# Connection pool for faster operations
+# Where the APK is staged on each device before `pm install`; named after the
+# APK's content so a staged copy can be reused without hashing it on the device
+REMOTE_APK_DIR = '/data/local/tmp'
+
+def remote_apk_path(sha256):
+    return f"{REMOTE_APK_DIR}/deploy-{sha256[:12]}.apk"
+
+# Connection pool for faster operations: device ip -> cached device state
+# ({'shell': adb_proto.PersistentShell or None, 'su_format': 'su 0' / 'su -c' / None,
+#   'alive_until': time.monotonic() deadline until which the connection is trusted,
+#   'one_shot': True when the device's interactive shell echoes input, so every
+#   command goes over its own shell: stream instead})
 active_connections = {}
 connection_lock = threading.Lock()
+# Per-device locks so connecting one device does not block the others
+device_locks = {}
+
+# Seconds a successful connection check or shell command vouches for a device
+CONNECTION_TTL = 10.0
+# Upper bound on waiting for a freshly connected device to come up
+DEVICE_READY_TIMEOUT = 10
+# Pause before retrying a connect that was refused outright
+CONNECT_RETRY_BACKOFF = 1.0
+
+# Upper bound on probe threads; workers only wait on adb sockets
+MAX_FANOUT_WORKERS = 64
+
+# Install workers live for the life of the process; each run limits itself
+# to max_parallel of them with a semaphore
+INSTALL_POOL_SIZE = 32
+install_executor = ThreadPoolExecutor(max_workers=INSTALL_POOL_SIZE, thread_name_prefix='adb-install')
+
+def fanout_workers(devices):
+    return min(MAX_FANOUT_WORKERS, len(devices))
+
+# Whole-request budgets for the fan-out routes; stragglers are reported as timed out
+TEST_CONNECTIONS_DEADLINE = 30
+SET_DATE_DEADLINE = 120
+
+def fan_out(worker, devices, deadline, timeout_result, max_workers=MAX_FANOUT_WORKERS):
+    """Run worker(device) for each device, results in completion order
+
+    Devices that have not finished within `deadline` seconds (None: no
+    limit) get timeout_result(device) instead of holding up the whole
+    response. At most `max_workers` devices are worked on at once.
+    """
+    results = []
+    collected = set()
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, fanout_workers(devices)))
+    futures = {executor.submit(worker, device): device for device in devices}
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            collected.add(future)
+            results.append(future.result())
+    except FutureTimeout:
+        # A worker can finish after as_completed gave up, keep its real result
+        for future, device in futures.items():
+            if future in collected:
+                continue
+            if future.done():
+                results.append(future.result())
+            else:
+                future.cancel()
+                results.append(timeout_result(device))
+    finally:
+        # Don't wait on stragglers: they finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+def device_lock(device_ip):
+    with connection_lock:
+        return device_locks.setdefault(device_ip, threading.Lock())
+
+def run_pidfd(cmd, timeout):
+    """subprocess.run for adb: sleeps in poll() on a pidfd until the child exits
+
+    Returns (stdout, stderr, returncode) as bytes and raises
+    subprocess.TimeoutExpired like subprocess.run. Pipes are drained while
+    waiting so a chatty child cannot block on a full pipe. Falls back to
+    subprocess.run where pidfd_open is unavailable (non-Linux, old kernels).
+    
+    On POSIX close_fds=False skips the scan of every open descriptor before
+    exec. That is safe there: Python creates its fds (sockets, pipes, files)
+    non-inheritable (PEP 446), so adb still starts with only stdin/out/err,
+    and a child cannot keep another push's pipes or an adb socket open.
+    On Windows it would mean inheriting every inheritable handle, including
+    the pipe ends of concurrent pushes, so the default is kept there.
+    """
+    close_fds = os.name != 'posix'
+    if not hasattr(os, 'pidfd_open'):
+        result = subprocess.run(cmd, capture_output=True, timeout=timeout, close_fds=close_fds)
+        return result.stdout, result.stderr, result.returncode
+    
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=close_fds)
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+    except OSError:
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        return stdout, stderr, proc.returncode
+    
+    stdout_fd, stderr_fd = proc.stdout.fileno(), proc.stderr.fileno()
+    chunks = {stdout_fd: [], stderr_fd: []}
+    open_fds = set(chunks)
+    poller = select.poll()
+    for fd in open_fds:
+        poller.register(fd, select.POLLIN)
+    poller.register(pidfd, select.POLLIN)
+    deadline = time.monotonic() + timeout
+    exited = False
+    try:
+        while open_fds or not exited:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                proc.kill()
+                proc.wait()
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            for fd, _ in poller.poll(remaining * 1000):
+                if fd == pidfd:
+                    exited = True
+                    poller.unregister(pidfd)
+                    continue
+                data = os.read(fd, 65536)
+                if data:
+                    chunks[fd].append(data)
+                else:
+                    poller.unregister(fd)
+                    open_fds.discard(fd)
+        proc.wait()
+    finally:
+        os.close(pidfd)
+        proc.stdout.close()
+        proc.stderr.close()
+    return b''.join(chunks[stdout_fd]), b''.join(chunks[stderr_fd]), proc.returncode
 
 def run_adb_command(device_ip, command_parts, adb_path, timeout=20):
-    """Balanced ADB command execution"""
+    """Balanced ADB command execution, returns (output bytes, returncode)
+
+    Output stays undecoded: callers test it with b"..." markers and only
+    decode when reporting an error.
+    """
     try:
         if device_ip == 'connect':
             cmd = [str(adb_path)] + command_parts
         else:
             cmd = [str(adb_path), '-s', device_ip] + command_parts
         
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
-        return result.stdout + result.stderr, result.returncode
+        stdout, stderr, returncode = run_pidfd(cmd, timeout)
+        return stdout + stderr, returncode
     except subprocess.TimeoutExpired:
-        return f"Timeout after {timeout}s", 1
+        return f"Timeout after {timeout}s".encode(), 1
     except Exception as e:
-        return str(e), 1
+        return str(e).encode('utf-8', 'replace'), 1
 
-def ensure_reliable_connection(device_ip, adb_path, max_retries=2):
-    """Balanced connection - fast but reliable"""
+@lru_cache(maxsize=16)
+def _valid_adb(adb_path, mtime_ns, mode):
+    # The file type comes from the caller's stat, only access() is left to ask
+    return stat.S_ISREG(mode) and os.access(adb_path, os.X_OK)
+
+def valid_adb(adb_path):
+    """Is adb_path an executable file; cached until the file or its mode changes"""
+    try:
+        st = os.stat(adb_path)
+    except OSError:
+        return False
+    # chmod changes st_mode but not st_mtime, so both are part of the key
+    return _valid_adb(adb_path, st.st_mtime_ns, st.st_mode)
+
+# adb binaries whose server this process has already started
+_server_started = set()
+# Start attempts per binary, so workers refused by the same dead server
+# restart it once between them
+_server_generation = {}
+_server_lock = threading.Lock()
+
+def _start_server(adb_path):
+    """adb start-server; only a zero exit marks the server started (hold _server_lock)"""
+    _server_started.discard(adb_path)
+    try:
+        _, _, returncode = run_pidfd([str(adb_path), 'start-server'], timeout=10)
+        if returncode == 0:
+            _server_started.add(adb_path)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    finally:
+        # Bumped once the attempt is over: a refusal seen while it ran belongs to it
+        _server_generation[adb_path] = _server_generation.get(adb_path, 0) + 1
+
+def ensure_server(adb_path):
+    """Start the ADB server once per adb binary, handlers call this before fanning out"""
+    if adb_path in _server_started:
+        return
+    with _server_lock:
+        if adb_path not in _server_started:
+            _start_server(adb_path)
+
+def adb_server_call(adb_path, func, *args, timeout=10):
+    """Call into the ADB server socket, restarting the server only if it went away"""
+    try:
+        generation = _server_generation.get(adb_path, 0)
+        try:
+            return func(*args, timeout=timeout)
+        except ConnectionRefusedError:
+            with _server_lock:
+                # Skip the restart when another worker already did it meanwhile
+                if _server_generation.get(adb_path, 0) == generation:
+                    _start_server(adb_path)
+            return func(*args, timeout=timeout)
+    except socket.timeout:
+        raise subprocess.TimeoutExpired(func.__name__, timeout)
+
+def adb_shell(device_ip, command, adb_path, timeout=8):
+    """Run a shell command without spawning adb, returns (output, returncode)"""
+    return adb_server_call(adb_path, adb_proto.shell, device_ip, command, timeout=timeout)
+
+def adb_disconnect(device_ip, adb_path, timeout=5):
+    """Best-effort disconnect"""
+    try:
+        adb_server_call(adb_path, adb_proto.disconnect, device_ip, timeout=timeout)
+    except:
+        pass
+
+def connection_entry(device_ip):
+    """Cached state for a device, created on first use"""
     with connection_lock:
-        # Quick check if already connected
-        if device_ip in active_connections:
-            try:
-                test = subprocess.run([
-                    adb_path, '-s', device_ip, 'shell', 'echo "ping"'
-                ], capture_output=True, text=True, timeout=4)
-                if test.returncode == 0 and "ping" in test.stdout:
-                    return True
+        return active_connections.setdefault(device_ip, {'shell': None, 'su_format': None, 'alive_until': 0.0,
+                                                          'one_shot': False})
+
+def mark_alive(entry):
+    entry['alive_until'] = time.monotonic() + CONNECTION_TTL
+
+def drop_session(device_ip, shell=None):
+    """Forget a device's persistent shell (only if it is still `shell`, when given)"""
+    with connection_lock:
+        entry = active_connections.get(device_ip)
+        current = entry['shell'] if entry else None
+        if current is not None and (shell is None or current is shell):
+            entry['shell'] = None
+            entry['alive_until'] = 0.0
+            current.close()
+
+def close_sessions():
+    with connection_lock:
+        for entry in active_connections.values():
+            if entry['shell'] is not None:
+                entry['shell'].close()
+        active_connections.clear()
+
+def session_shell(device_ip, command, adb_path, timeout=8):
+    """Run a command on the device's persistent shell, opening it on first use"""
+    entry = connection_entry(device_ip)
+    if entry['one_shot']:
+        result = adb_shell(device_ip, command, adb_path, timeout)
+        mark_alive(entry)
+        return result
+    
+    shell = entry['shell']
+    cached = shell is not None
+    if not cached:
+        # Opened under the device lock so concurrent callers share one session
+        with device_lock(device_ip):
+            shell = entry['shell']
+            if shell is None and not entry['one_shot']:
+                try:
+                    shell = adb_server_call(adb_path, adb_proto.PersistentShell, device_ip, timeout=timeout)
+                except adb_proto.ShellEchoError:
+                    # No stty on the device: a command passed as shell:<cmd> is never echoed
+                    entry['one_shot'] = True
                 else:
-                    active_connections.pop(device_ip, None)
-            except:
-                active_connections.pop(device_ip, None)
+                    with connection_lock:
+                        entry['shell'] = shell
+        if shell is None:
+            return session_shell(device_ip, command, adb_path, timeout)
+    try:
+        result = shell.run(command, timeout)
+    except socket.timeout:
+        drop_session(device_ip, shell)
+        raise subprocess.TimeoutExpired(command, timeout)
+    except Exception:
+        drop_session(device_ip, shell)
+        if not cached:
+            raise
+        # The cached session went stale (device was reconnected), retry on a new one
+        return session_shell(device_ip, command, adb_path, timeout)
+    mark_alive(entry)
+    return result
+
+def device_state(device_ip, adb_path, timeout=2):
+    """Transport state from the ADB server (b'device', b'offline', ...)"""
+    try:
+        return adb_server_call(adb_path, adb_proto.get_state, device_ip, timeout=timeout).strip()
+    except:
+        return b"unknown"
+
+def wait_for_device_state(device_ip, adb_path, timeout=DEVICE_READY_TIMEOUT):
+    """Wait for the adb server to report the device ready, False on timeout"""
+    try:
+        adb_server_call(adb_path, adb_proto.wait_for_device, device_ip, timeout=timeout)
+        return True
+    except:
+        return False
+
+def ensure_reliable_connection(device_ip, adb_path, max_retries=2):
+    """Balanced connection - fast but reliable"""
+    # Recently verified: trust it without another round trip
+    entry = connection_entry(device_ip)
+    if time.monotonic() < entry['alive_until']:
+        return True
+    
+    with device_lock(device_ip):
+        # Healthy transport: nothing to do, the shell session is opened on demand
+        if device_state(device_ip, adb_path) == b"device":
+            mark_alive(entry)
+            return True
         
-        # Connection attempts with proper cleanup
+        drop_session(device_ip)
+        
+        # Connection attempts with proper cleanup; the wait for the device
+        # paces retries, a refused connect gets a short backoff instead
         for attempt in range(max_retries):
+            result = b""
             try:
-                # Clean disconnect first
-                subprocess.run([adb_path, 'disconnect', device_ip], 
-                              capture_output=True, timeout=5)
-                time.sleep(1)
-                
                 # Connect
-                result = subprocess.run([
-                    adb_path, 'connect', device_ip
-                ], capture_output=True, text=True, timeout=12)
+                result = adb_server_call(adb_path, adb_proto.connect, device_ip, timeout=12)
                 
-                if "connected" in result.stdout or "already connected" in result.stdout:
-                    # Verify connection works
-                    time.sleep(1)
-                    test = subprocess.run([
-                        adb_path, '-s', device_ip, 'shell', 'echo "test_ok"'
-                    ], capture_output=True, text=True, timeout=6)
+                # b"connected" also matches "already connected to ..."
+                if b"connected" in result and \
+                        wait_for_device_state(device_ip, adb_path):
+                    # Verify connection works and keep the shell open for later commands
+                    entry = connection_entry(device_ip)
+                    try:
+                        shell = adb_server_call(adb_path, adb_proto.PersistentShell, device_ip, timeout=6)
+                    except adb_proto.ShellEchoError:
+                        # Echoing shell: session_shell sends each command on its own stream
+                        entry['one_shot'] = True
+                        shell = None
+                    
+                    if shell is None:
+                        output, returncode = adb_shell(device_ip, 'echo "test_ok"', adb_path, timeout=6)
+                    else:
+                        output, returncode = shell.run('echo "test_ok"', timeout=6)
                     
-                    if test.returncode == 0 and "test_ok" in test.stdout:
-                        active_connections[device_ip] = True
+                    if returncode == 0 and "test_ok" in output:
+                        entry['shell'] = shell
+                        mark_alive(entry)
                         return True
+                    if shell is not None:
+                        shell.close()
                         
             except:
                 pass
             
-            if attempt < max_retries - 1:
-                time.sleep(2)
+            # Reset the transport only after a failed attempt
+            adb_disconnect(device_ip, adb_path)
+            
+            # "unable to connect"/"failed to connect" comes back at once;
+            # retrying immediately would just be refused again
+            if b"connected" not in result and attempt < max_retries - 1:
+                time.sleep(CONNECT_RETRY_BACKOFF)
         
         return False
 
-@lru_cache(maxsize=32)
-def get_apk_size(apk_path):
-    """Cache APK size calculation"""
+def file_sha256(path):
+    """sha256 of a file, read in 1MB chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def validate_apk(apk_path):
+    """Check the APK once per run, returns its sha256
+
+    Raises ValueError when the file is not a zip with an AndroidManifest.xml,
+    so a bad upload fails here instead of on every device.
+    """
     try:
-        return Path(apk_path).stat().st_size / (1024 * 1024)
-    except:
-        return 10
+        with zipfile.ZipFile(apk_path) as apk:
+            if 'AndroidManifest.xml' not in apk.namelist():
+                raise ValueError("APK has no AndroidManifest.xml")
+    except zipfile.BadZipFile:
+        raise ValueError("APK file is not a valid zip archive")
+    return file_sha256(apk_path)
 
 def calculate_install_timeout(apk_size):
     """Calculate ultra-conservative install timeout"""
@@ -123,34 +558,48 @@ def calculate_install_timeout(apk_size):
     
     return max(300, int(total_timeout))  # Minimum 5 minutes
 
+# Tags the on-device probes and launch chain echo back, each output is
+# scanned once for all of them instead of once per tag. ROOT_PROBE splits
+# its tags with empty quotes so the command text itself never contains them
+ROOT_PROBE = 'su 0 echo ROOT_SU""0 2>/dev/null; su -c "echo ROOT_SU\'\'C" 2>/dev/null'
+ROOT_TAG_RE = re.compile(r'^ROOT_SU(0|C)\r?$', re.M)
+LAUNCH_TAG_RE = re.compile(r'LAUNCHED_VIA:(\w+)')
+VERSION_CODE_RE = re.compile(r'versionCode=(\d+)')
+LAUNCH_MESSAGES = {
+    'resolved': "Launched",
+    'MainActivity': "Launched",
+    'LauncherActivity': "Launched via LauncherActivity",
+    'monkey': "Launched via monkey"
+}
+
+def su_format_from(output):
+    """Working su form from ROOT_SU0/ROOT_SUC probe output, 'su 0' preferred"""
+    tags = set(ROOT_TAG_RE.findall(output))
+    if '0' in tags:
+        return 'su 0'
+    if 'C' in tags:
+        return 'su -c'
+    return None
+
 def check_device_root_status(device_ip, adb_path):
     """Reliable root check with multiple methods"""
     try:
         if not ensure_reliable_connection(device_ip, adb_path):
             return False, "Connection failed"
         
-        # Test su 0 format first (your working format)
-        result = subprocess.run([
-            adb_path, '-s', device_ip, 'shell', 'su 0 echo "ROOT_OK"'
-        ], capture_output=True, text=True, timeout=8)
-        
-        if "ROOT_OK" in result.stdout:
-            return True, "Device is rooted (su 0 confirmed)"
-        
-        # Try su -c format
-        result = subprocess.run([
-            adb_path, '-s', device_ip, 'shell', 'su -c "echo ROOT_OK"'
-        ], capture_output=True, text=True, timeout=8)
-        
-        if "ROOT_OK" in result.stdout:
-            return True, "Device is rooted (su -c confirmed)"
+        # su 0 (your working format), su -c and the su binary lookup in one round trip
+        output, _ = session_shell(device_ip, 
+            f'{ROOT_PROBE}; echo "SU_PATH:$(which su)"', 
+            adb_path, timeout=16)
         
-        # Check for su binary existence
-        which_su = subprocess.run([
-            adb_path, '-s', device_ip, 'shell', 'which su'
-        ], capture_output=True, text=True, timeout=6)
+        # Remember the working su form so /set_date can skip its own probe
+        su_format = su_format_from(output)
+        if su_format:
+            connection_entry(device_ip)['su_format'] = su_format
+            return True, f"Device is rooted ({su_format} confirmed)"
         
-        if which_su.returncode == 0 and which_su.stdout.strip():
+        su_path = output.rpartition("SU_PATH:")[2].strip()
+        if su_path:
             return True, "Device is rooted (su binary found)"
         
         return False, "Device is not rooted"
@@ -160,46 +609,96 @@ def check_device_root_status(device_ip, adb_path):
     except Exception as e:
         return False, f"Error: {str(e)[:40]}"
 
-def launch_app_fast(device_ip, package_name, adb_path):
-    """Fast app launch with fallbacks"""
+def probe_device(device_ip, adb_path):
+    """Connection, root form, model and Android version in one shell round trip"""
+    probe = {'device': device_ip, 'connected': False, 'rooted': False, 'su_format': None,
+             'model': "Unknown", 'version': "Unknown", 'error': None}
     try:
-        result = subprocess.run([
-            adb_path, '-s', device_ip, 'shell', 'am', 'start', '-n', 
-            f"{package_name}/.MainActivity"
-        ], capture_output=True, text=True, timeout=10)
+        if not ensure_reliable_connection(device_ip, adb_path):
+            probe['error'] = "Connection failed"
+            return probe
         
-        if result.returncode == 0 and "Error" not in result.stdout:
-            return True, "Launched"
-    except:
-        pass
-    
-    try:
-        result = subprocess.run([
-            adb_path, '-s', device_ip, 'shell', 'am', 'start', '-n', 
-            f"{package_name}/.LauncherActivity"
-        ], capture_output=True, text=True, timeout=10)
+        output, _ = session_shell(device_ip, 
+            f'echo STATE:ok; {ROOT_PROBE}; '
+            'echo "SU_PATH:$(which su)"; echo "MODEL:$(getprop ro.product.model)"; '
+            'echo "VERSION:$(getprop ro.build.version.release)"', 
+            adb_path, timeout=16)
         
-        if result.returncode == 0 and "Error" not in result.stdout:
-            return True, "Launched via LauncherActivity"
-    except:
-        pass
+        fields = {}
+        for line in output.split('\n'):
+            key, sep, value = line.partition(':')
+            if sep:
+                fields[key.strip()] = value.strip()
+        
+        probe['connected'] = fields.get('STATE') == 'ok'
+        probe['model'] = fields.get('MODEL') or "Unknown"
+        probe['version'] = fields.get('VERSION') or "Unknown"
+        
+        probe['su_format'] = su_format_from(output)
+        probe['rooted'] = bool(probe['su_format'] or fields.get('SU_PATH'))
+        
+        # Same cache /check_root_status fills, so /set_date can skip its probe
+        if probe['su_format']:
+            connection_entry(device_ip)['su_format'] = probe['su_format']
+        
+    except subprocess.TimeoutExpired:
+        probe['error'] = "Connection timeout"
+    except Exception as e:
+        probe['error'] = f"Error: {str(e)[:40]}"
+    
+    return probe
+
+def wait_for_package(device_ip, package_name, adb_path, timeout=2.0, interval=0.1):
+    """Poll the package manager until the package is registered"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            output, _ = session_shell(device_ip, f"pm path {package_name}", adb_path, timeout=5)
+            if "package:" in output:
+                return True
+        except:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+
+def launch_app_fast(device_ip, package_name, adb_path):
+    """Fast app launch with fallbacks, all tried on the device in one round trip"""
+    def am_start(component, tag):
+        # am start exits 0 even when the activity is missing, so check its output too
+        return (f'out=$(am start -n {component} 2>&1) && '
+                f'case "$out" in *Error*) false;; esac && echo LAUNCHED_VIA:{tag}')
+    
+    # Ask the package manager for the real launcher activity (last line of
+    # --brief is pkg/.Activity); guessed names are only a fallback for old devices
+    resolve = (f'comp=$(cmd package resolve-activity --brief -c android.intent.category.LAUNCHER '
+               f'{package_name} 2>/dev/null | tail -n 1) && case "$comp" in */*) ;; *) false;; esac')
+    
+    launch_chain = " || ".join([
+        f'{{ {resolve} && {am_start("$comp", "resolved")}; }}',
+        f'{{ {am_start(f"{package_name}/.MainActivity", "MainActivity")}; }}',
+        f'{{ {am_start(f"{package_name}/.LauncherActivity", "LauncherActivity")}; }}',
+        f'{{ monkey -p {package_name} -c android.intent.category.LAUNCHER 1 >/dev/null 2>&1 && echo LAUNCHED_VIA:monkey; }}'
+    ])
     
     try:
-        result = subprocess.run([
-            adb_path, '-s', device_ip, 'shell', 'monkey', '-p', package_name, 
-            '-c', 'android.intent.category.LAUNCHER', '1'
-        ], capture_output=True, text=True, timeout=10)
-        
-        if result.returncode == 0:
-            return True, "Launched via monkey"
+        output, _ = session_shell(device_ip, launch_chain, adb_path, timeout=30)
     except:
-        pass
+        return False, "Launch failed"
+    
+    # The || chain stops at the first method that worked, so there is at most one tag
+    match = LAUNCH_TAG_RE.search(output)
+    if match and match.group(1) in LAUNCH_MESSAGES:
+        return True, LAUNCH_MESSAGES[match.group(1)]
     
     return False, "Launch failed"
 
 def install_on_device_balanced(device_ip, config):
     """Installation with ULTRA-CONSERVATIVE timeout calculation"""
-    timestamp = datetime.now().isoformat()
+    # Formatted only when the CSV row is written
+    ts_ns = time.time_ns()
+    # ULTRA-CONSERVATIVE TIMEOUT, computed once per run in run_installation_balanced
+    install_timeout = config['install_timeout']
     uninstall_verified = "NO"
     install_verified = "NO"
     launch_status = "NO"
@@ -213,42 +712,80 @@ def install_on_device_balanced(device_ip, config):
         
         print(f"Connected to {device_ip}")
         
-        # Quick uninstall with longer timeout
+        # Nothing to push when the device already runs this exact build
+        if config['check_installed_version']:
+            try:
+                output, _ = session_shell(device_ip, f"dumpsys package {config['launch_package']} | grep -m 1 versionCode=", 
+                                          config['adb_path'], timeout=15)
+                match = VERSION_CODE_RE.search(output)
+                installed_version = int(match.group(1)) if match else None
+            except Exception as e:
+                # Only an optimisation: a failed probe means a normal install
+                print(f"versionCode check failed on {device_ip}, installing: {e}")
+                installed_version = None
+            
+            if installed_version == config['apk_version_code']:
+                print(f"versionCode {config['apk_version_code']} already installed on {device_ip}, skipping")
+                install_verified = "SKIPPED"
+                status_msg = f"versionCode {config['apk_version_code']} already installed"
+                if config['auto_launch']:
+                    success, _ = launch_app_fast(device_ip, config['launch_package'], config['adb_path'])
+                    launch_status = "YES" if success else "NO"
+                    status_msg += ", launched" if success else ", launch failed"
+                return ts_ns, device_ip, "SKIPPED", status_msg, uninstall_verified, install_verified, launch_status
+        
+        # Quick uninstall with longer timeout, over the device's shell session
         if config['old_package']:
             try:
                 print(f"Uninstalling {config['old_package']} on {device_ip}")
-                subprocess.run([
-                    config['adb_path'], '-s', device_ip, 'uninstall', config['old_package']
-                ], capture_output=True, timeout=60)  # Increased from 30s
+                output, returncode = session_shell(device_ip, f"pm uninstall {config['old_package']}", 
+                                                   config['adb_path'], timeout=60)  # Increased from 30s
+                removed = returncode == 0 or "Success" in output
                 
-                subprocess.run([
-                    config['adb_path'], '-s', device_ip, 'shell', 'pm', 'uninstall', 
-                    '--user', '0', config['old_package']
-                ], capture_output=True, timeout=60)  # Increased from 30s
+                if not removed:
+                    output, returncode = session_shell(device_ip, f"pm uninstall --user 0 {config['old_package']}", 
+                                                       config['adb_path'], timeout=60)  # Increased from 30s
+                    removed = returncode == 0 or "Success" in output
                 
-                uninstall_verified = "ATTEMPTED"
+                if removed:
+                    uninstall_verified = "YES"
+                else:
+                    # Both removals failed, which is also what an absent package looks like;
+                    # pm filters the list on the device so only matching names come back
+                    listed, _ = session_shell(device_ip, f"pm list packages {config['old_package']}", 
+                                              config['adb_path'], timeout=30)
+                    still_installed = f"package:{config['old_package']}" in listed.split()
+                    uninstall_verified = "NO" if still_installed else "YES"
             except:
                 pass
         
-        # ULTRA-CONSERVATIVE TIMEOUT CALCULATION
-        apk_size = get_apk_size(config['apk_path'])
-        install_timeout = calculate_install_timeout(apk_size)
-        
-        print(f"APK size: {apk_size:.1f}MB, Install timeout: {install_timeout}s ({install_timeout/60:.1f} minutes) for {device_ip}")
+        # Stage the APK on the device. The path is content addressed, so a copy
+        # of the full size left by a previous run is this APK and is not pushed again
+        remote_apk = config['remote_apk']
+        staged, _ = session_shell(device_ip, f'[ "$(stat -c %s {remote_apk} 2>/dev/null)" = "{config["apk_size"]}" ] && echo STAGED', 
+                                  config['adb_path'], timeout=10)
+        if "STAGED" in staged:
+            print(f"APK already staged on {device_ip}, skipping push")
+        else:
+            # Drop copies of other builds so /data/local/tmp does not fill up
+            session_shell(device_ip, f"rm -f {REMOTE_APK_DIR}/deploy*.apk", config['adb_path'], timeout=10)
+            output, returncode = run_adb_command(device_ip, ['push', config['apk_path'], remote_apk], 
+                                                 config['adb_path'], timeout=install_timeout)
+            if returncode != 0:
+                raise Exception(f"Push failed: {output.decode('utf-8', 'replace')}")
         
         # Install with very long timeout
-        result = subprocess.run([
-            config['adb_path'], '-s', device_ip, 'install', '-r', '-d', config['apk_path']
-        ], capture_output=True, text=True, timeout=install_timeout)
+        output, _ = session_shell(device_ip, f"pm install -r -d {remote_apk}", 
+                                  config['adb_path'], timeout=install_timeout)
         
-        if "Success" in result.stdout:
+        if "Success" in output:
             install_verified = "YES"
             print(f"Installation successful on {device_ip}")
             
             # Fast app launch
             if config['auto_launch'] and config['launch_package']:
                 print(f"Launching app on {device_ip}")
-                time.sleep(2)  # Slightly longer wait
+                wait_for_package(device_ip, config['launch_package'], config['adb_path'])
                 success, launch_msg = launch_app_fast(device_ip, config['launch_package'], config['adb_path'])
                 launch_status = "YES" if success else "NO"
                 
@@ -261,97 +798,159 @@ def install_on_device_balanced(device_ip, config):
             elif config['auto_launch']:
                 status_msg += " but launch failed"
             
-            return timestamp, device_ip, "SUCCESS", status_msg, uninstall_verified, install_verified, launch_status
+            return ts_ns, device_ip, "SUCCESS", status_msg, uninstall_verified, install_verified, launch_status
         else:
-            error_details = f"Install failed: {result.stderr or result.stdout}"
+            error_details = f"Install failed: {output}"
             print(f"Installation failed on {device_ip}: {error_details}")
             raise Exception(error_details)
             
     except subprocess.TimeoutExpired:
         error_msg = f"Install timeout after {install_timeout}s ({install_timeout/60:.1f} minutes)"
         print(f"Timeout error for {device_ip}: {error_msg}")
-        return timestamp, device_ip, "FAILED", error_msg, uninstall_verified, install_verified, launch_status
+        return ts_ns, device_ip, "FAILED", error_msg, uninstall_verified, install_verified, launch_status
     except Exception as e:
         error_msg = str(e)[:150]
         print(f"Error for {device_ip}: {error_msg}")
-        return timestamp, device_ip, "FAILED", error_msg, uninstall_verified, install_verified, launch_status
-    finally:
-        # Cleanup connection
-        try:
-            subprocess.run([config['adb_path'], 'disconnect', device_ip], 
-                          capture_output=True, timeout=10)
-        except:
-            pass
+        return ts_ns, device_ip, "FAILED", error_msg, uninstall_verified, install_verified, launch_status
+
+def device_subnet(device_ip):
+    """Locality key for scheduling: the /24 of an ip[:port] address"""
+    return device_ip.rsplit(':', 1)[0].rsplit('.', 1)[0]
 
 def run_installation_balanced(config):
     """Installation runner with reduced parallelism for stability"""
-    global installation_progress
-    devices = [ip.strip() for ip in config['devices'] if ip.strip()]
-    
-    installation_progress.update({
-        'status': 'running',
-        'total_devices': len(devices),
-        'completed': 0,
-        'success': 0,
-        'failed': 0,
-        'results': [],
-        'log_file': config['log_file']
-    })
+    devices = config['devices']
+    
+    # Timeout once per run instead of per device
+    config['apk_size_mb'] = config['apk_size'] / (1024 * 1024)
+    config['install_timeout'] = calculate_install_timeout(config['apk_size_mb'])
+    print(f"APK size: {config['apk_size_mb']:.1f}MB, Install timeout: {config['install_timeout']}s "
+          f"({config['install_timeout']/60:.1f} minutes)")
     
-    # Initialize log file
-    with open(config['log_file'], 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(["Timestamp", "Device", "Status", "Details", "UninstallVerified", "InstallVerified", "LaunchStatus"])
+    # One warm server for the whole run, started before any worker can race
+    # to spawn it; it is left running for the next run
+    ensure_server(config['adb_path'])
     
-    # Reduced parallelism for better stability with longer timeouts
-    max_workers = min(config['max_parallel'], len(devices))
-    print(f"Starting installation with {max_workers} parallel workers (reduced for stability)")
+    # No more workers than devices, nor than the shared pool has
+    max_workers = min(config['max_parallel'], len(devices), INSTALL_POOL_SIZE)
+    if config['max_parallel'] > INSTALL_POOL_SIZE:
+        print(f"Max parallel {config['max_parallel']} exceeds the install pool size, using {INSTALL_POOL_SIZE}")
+    print(f"Starting installation with {max_workers} parallel workers")
+    slots = threading.BoundedSemaphore(max_workers)
     
-    # Batch logging for speed
-    batch_results = []
-    batch_size = 3
+    def install(device):
+        with slots:
+            return install_on_device_balanced(device, config)
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_device = {executor.submit(install_on_device_balanced, device, config): device for device in devices}
+    # CSV rows go through a queue to a writer thread so disk stalls never
+    # hold up the completion loop; None ends the log. Rows are formatted in
+    # memory and reach the file in one os.write every LOG_FLUSH_ROWS rows,
+    # with the remainder written when the run ends
+    log_queue = queue.Queue()
+    
+    def write_log():
+        try:
+            # O_BINARY keeps Windows from turning csv's \r\n into \r\r\n
+            fd = os.open(config['log_file'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND |
+                         getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            # Reported rather than raised: a thread exception would only reach stderr
+            print(f"Install log write error: {e}")
+            return
         
-        for future in as_completed(future_to_device):
+        pending = io.StringIO()
+        writer = csv.writer(pending)
+        
+        def flush_rows():
+            data = memoryview(pending.getvalue().encode('utf-8'))
+            while data:
+                data = data[os.write(fd, data):]
+            pending.seek(0)
+            pending.truncate()
+        
+        try:
+            writer.writerow(LOG_HEADER)
+            rows = 0
+            while True:
+                row = log_queue.get()
+                if row is None:
+                    break
+                writer.writerow(format_result(row))
+                rows += 1
+                if rows % LOG_FLUSH_ROWS == 0:
+                    flush_rows()
+            flush_rows()
+        except OSError as e:
+            print(f"Install log write error: {e}")
+        finally:
+            os.close(fd)
+    
+    log_writer = threading.Thread(target=write_log, name='install-log', daemon=True)
+    log_writer.start()
+    
+    # Devices are taken one subnet at a time: a group is connected, at most
+    # max_parallel at once, then its installs are queued while the next group
+    # connects. Finished futures are collected from a queue since they are
+    # submitted gradually
+    groups = {}
+    for device in devices:
+        groups.setdefault(device_subnet(device), []).append(device)
+    ordered = [device for group in groups.values() for device in group]
+    finished = queue.Queue()
+    
+    def preconnect(device):
+        # Connects share the install slots, so max_parallel bounds all device traffic
+        with slots:
+            return ensure_reliable_connection(device, config['adb_path'])
+    
+    def schedule():
+        scheduled = 0
+        try:
+            for group in groups.values():
+                try:
+                    fan_out(preconnect, group, None, lambda ip: None, max_workers=max_workers)
+                except Exception as e:
+                    # Pre-connecting is only an optimisation, each install connects anyway
+                    print(f"Pre-connect error: {e}")
+                for device in group:
+                    install_executor.submit(install, device).add_done_callback(finished.put)
+                    scheduled += 1
+        except Exception as e:
+            # The completion loop waits for one future per device: fail the rest
+            print(f"Install scheduling error: {e}")
+            for device in ordered[scheduled:]:
+                future = Future()
+                future.set_result((time.time_ns(), device, "FAILED", f"Not scheduled: {str(e)[:100]}",
+                                   "NO", "NO", "NO"))
+                finished.put(future)
+    
+    try:
+        threading.Thread(target=schedule, name='install-schedule', daemon=True).start()
+        
+        for _ in devices:
+            future = finished.get()
             try:
                 result = future.result()
-                installation_progress['results'].append(result)
-                installation_progress['completed'] += 1
-                
-                if result[2] == "SUCCESS":
-                    installation_progress['success'] += 1
-                else:
-                    installation_progress['failed'] += 1
+                completed = progress.record(result)
                 
-                # Batch logging
-                batch_results.append(result)
-                if len(batch_results) >= batch_size:
-                    with open(config['log_file'], 'a', newline='', encoding='utf-8') as f:
-                        writer = csv.writer(f)
-                        writer.writerows(batch_results)
-                    batch_results.clear()
+                log_queue.put(result)
                 
-                print(f"Completed {installation_progress['completed']}/{installation_progress['total_devices']}: {result[1]} - {result[2]}")
+                print(f"Completed {completed}/{len(devices)}: {result[1]} - {result[2]}")
                     
             except Exception as e:
                 print(f"Future execution error: {e}")
-                installation_progress['completed'] += 1
-                installation_progress['failed'] += 1
-    
-    # Write remaining results
-    if batch_results:
-        with open(config['log_file'], 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerows(batch_results)
+                progress.record_error()
+    finally:
+        # Ends the writer, which closes the log, even if the loop fails;
+        # the log must be complete before the run is reported as done
+        log_queue.put(None)
+        log_writer.join()
     
-    installation_progress['status'] = 'completed'
+    progress.finish()
     print("Installation process completed")
     
     # Cleanup connections
-    with connection_lock:
-        active_connections.clear()
+    close_sessions()
 
 @app.route('/')
 def index():
@@ -359,31 +958,59 @@ def index():
 
 @app.route('/start_installation', methods=['POST'])
 def start_installation():
-    global installation_progress
-    
-    if installation_progress['status'] == 'running':
-        return jsonify({'error': 'Installation already in progress'})
-    
     data = request.json
+    devices = [ip.strip() for ip in data.get('devices', '').split('\n') if ip.strip()]
     
-    if not data.get('devices'):
+    if not devices:
         return jsonify({'error': 'No devices specified'})
     if not data.get('apk_path') or not os.path.exists(data['apk_path']):
         return jsonify({'error': 'APK file not found'})
-    if not data.get('adb_path') or not os.path.exists(data['adb_path']):
+    if not data.get('adb_path') or not valid_adb(data['adb_path']):
         return jsonify({'error': 'ADB executable not found'})
     
+    # Installs are network-bound, so parallelism is the user's choice up to one worker per device
+    try:
+        max_parallel = int(data.get('max_parallel', 4))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Max parallel must be a number'})
+    if max_parallel < 1:
+        return jsonify({'error': 'Max parallel must be at least 1'})
+    
+    try:
+        apk_sha256 = validate_apk(data['apk_path'])
+    except (OSError, ValueError) as e:
+        return jsonify({'error': str(e)})
+    
+    # Package and versionCode let devices already on this build be skipped;
+    # an unreadable manifest only turns that check off
+    try:
+        apk_package, apk_version_code = apk_manifest.read_manifest(data['apk_path'])
+    except ValueError as e:
+        print(f"APK manifest not readable, installing on every device: {e}")
+        apk_package, apk_version_code = None, None
+    
     config = {
-        'devices': data['devices'].split('\n'),
+        'devices': devices,
         'apk_path': data['apk_path'],
+        'apk_size': os.path.getsize(data['apk_path']),
+        'remote_apk': remote_apk_path(apk_sha256),
         'adb_path': data['adb_path'],
         'old_package': data.get('old_package', ''),
         'launch_package': data.get('launch_package', ''),
         'auto_launch': data.get('auto_launch', False),
-        'max_parallel': min(int(data.get('max_parallel', 4)), 6),  # Reduced for stability
+        'max_parallel': max_parallel,
+        'apk_version_code': apk_version_code,
+        # Only when launch_package is this APK, and not when it is being uninstalled first
+        'check_installed_version': bool(apk_version_code is not None and apk_package
+                                        and data.get('launch_package') == apk_package
+                                        and data.get('old_package') != apk_package),
         'log_file': f"install_log_{datetime.now().strftime('%Y%m%d-%H%M%S')}.csv"
     }
     
+    # Reset progress before the worker starts so stream clients never see the previous run
+    if not progress.start(len(devices), config['log_file']):
+        return jsonify({'error': 'Installation already in progress'})
+    
     print(f"Starting installation with config: max_parallel={config['max_parallel']}")
     
     thread = threading.Thread(target=run_installation_balanced, args=(config,))
@@ -394,28 +1021,90 @@ def start_installation():
 
 @app.route('/progress')
 def get_progress():
-    return jsonify(installation_progress)
+    """Progress snapshot; with ?since=<index> only results from that index on
+
+    The since form returns new_results and next_index instead of the whole
+    results list, so a poller's payload grows with what changed, not the run.
+    """
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error': 'since must be a result index'})
+        if since < 0:
+            return jsonify({'error': 'since must be a result index'})
+    
+    etag = progress.etag()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    if since is None:
+        etag, snapshot = progress.snapshot()
+    else:
+        etag, snapshot = progress.results_since(since, PROGRESS_RESULTS_LIMIT)
+    response = jsonify(snapshot)
+    response.set_etag(etag)
+    # Let the browser revalidate every poll instead of serving its cached copy
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/progress_stream')
+def progress_stream():
+    """Server-Sent Events: a snapshot, then one JSON delta per completed device"""
+    events, snapshot = progress.subscribe()
+    
+    def stream():
+        try:
+            yield f"data: {json.dumps(snapshot)}\n\n"
+            status = snapshot['status']
+            while status == 'running':
+                try:
+                    delta = events.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                status = delta['status']
+                yield f"data: {json.dumps(delta)}\n\n"
+        finally:
+            progress.unsubscribe(events)
+    
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/config')
+def get_config():
+    """Effective worker limits, so a max_parallel above the pool size is visible"""
+    return jsonify({
+        'install_pool_size': INSTALL_POOL_SIZE,
+        'max_fanout_workers': MAX_FANOUT_WORKERS
+    })
 
 @app.route('/download_log')
 def download_log():
-    if installation_progress['log_file'] and os.path.exists(installation_progress['log_file']):
-        return send_file(installation_progress['log_file'], as_attachment=True)
+    log_file = progress.log_file
+    if log_file and os.path.exists(log_file):
+        return send_file(log_file, as_attachment=True)
     return jsonify({'error': 'Log file not found'})
 
 @app.route('/check_root_status', methods=['POST'])
 def check_root_status():
+    """Deprecated: /device_probe returns root status together with device info"""
     data = request.json
     devices = [ip.strip() for ip in data.get('devices', '').split('\n') if ip.strip()]
     adb_path = data.get('adb_path')
     
-    if not devices or not adb_path or not os.path.exists(adb_path):
+    if not devices or not adb_path or not valid_adb(adb_path):
         return jsonify({'message': 'Missing or invalid ADB path'}), 400
     
+    ensure_server(adb_path)
+    
     results = []
     rooted_count = 0
     
-    # Balanced parallelism for root checking
-    with ThreadPoolExecutor(max_workers=min(6, len(devices))) as executor:
+    # One worker per device, the probes are pure round-trip latency
+    with ThreadPoolExecutor(max_workers=fanout_workers(devices)) as executor:
         future_to_device = {executor.submit(check_device_root_status, device, adb_path): device for device in devices}
         
         for future in as_completed(future_to_device):
@@ -459,141 +1148,76 @@ def set_date():
     except Exception as e:
         return jsonify({'message': f'Invalid date format: {e}'}), 400
 
-    if not os.path.exists(adb_path):
+    if not valid_adb(adb_path):
         return jsonify({'message': 'ADB executable not found'}), 400
+    
+    ensure_server(adb_path)
 
     def set_date_on_device_reliable(device):
         try:
-            # Step 1: Ensure solid connection with retries
-            connected = False
-            for attempt in range(2):
-                try:
-                    # Disconnect and reconnect cleanly
-                    subprocess.run([adb_path, 'disconnect', device], 
-                                  capture_output=True, timeout=5)
-                    time.sleep(1)
-                    
-                    connect_result = subprocess.run([
-                        adb_path, 'connect', device
-                    ], capture_output=True, text=True, timeout=12)
-                    
-                    if "connected" in connect_result.stdout or "already connected" in connect_result.stdout:
-                        # Test connection
-                        time.sleep(1)
-                        test = subprocess.run([
-                            adb_path, '-s', device, 'shell', 'echo "connection_ok"'
-                        ], capture_output=True, text=True, timeout=8)
-                        
-                        if test.returncode == 0 and "connection_ok" in test.stdout:
-                            connected = True
-                            break
-                except:
-                    pass
-                
-                if attempt < 1:
-                    time.sleep(2)
-            
-            if not connected:
+            # Step 1: Ensure solid connection, reconnecting only if the device is not ready
+            if not ensure_reliable_connection(device, adb_path):
                 return f"❌ {device}: Connection failed"
             
-            # Step 2: Check root access with multiple methods
-            root_available = False
-            
-            # Try su 0 first (your working format)
-            try:
-                root_check = subprocess.run([
-                    adb_path, '-s', device, 'shell', 'su 0 echo "ROOT_CHECK"'
-                ], capture_output=True, text=True, timeout=8)
-                
-                if root_check.returncode == 0 and "ROOT_CHECK" in root_check.stdout:
-                    root_available = True
-                    su_format = 'su 0'
-            except:
-                pass
-            
-            # Try su -c as fallback
-            if not root_available:
+            # Step 2: Check root access, su 0 (your working format) and su -c in one probe,
+            # unless /check_root_status already found the working form
+            entry = connection_entry(device)
+            su_format = entry['su_format']
+            if not su_format:
                 try:
-                    root_check = subprocess.run([
-                        adb_path, '-s', device, 'shell', 'su -c "echo ROOT_CHECK"'
-                    ], capture_output=True, text=True, timeout=8)
-                    
-                    if root_check.returncode == 0 and "ROOT_CHECK" in root_check.stdout:
-                        root_available = True
-                        su_format = 'su -c'
+                    output, _ = session_shell(device, 
+                        ROOT_PROBE, 
+                        adb_path, timeout=12)
                 except:
-                    pass
-            
-            if not root_available:
-                return f"🔒 {device}: Not rooted or root access denied"
+                    output = ""
+                
+                su_format = su_format_from(output)
+                if not su_format:
+                    return f"🔒 {device}: Not rooted or root access denied"
+                entry['su_format'] = su_format
             
-            # Step 3: Try multiple date setting methods
+            # Step 3: Try every date setting method in a single shell, stopping at the
+            # first one whose result shows the target year, then report the final date
+            date_commands = []
             for date_format in date_formats:
-                date_commands = []
-                
                 if su_format == 'su 0':
-                    date_commands = [
+                    date_commands += [
                         f'su 0 date -s "{date_format}"',
                         f'su 0 date "{date_format}"',
                         f'su 0 toolbox date -s "{date_format}"',
                         f'su 0 busybox date -s "{date_format}"'
                     ]
                 else:
-                    date_commands = [
+                    date_commands += [
                         f'su -c "date -s \\"{date_format}\\""',
                         f'su -c "date \\"{date_format}\\""',
                         f'su -c "toolbox date -s \\"{date_format}\\""',
                         f'su -c "busybox date -s \\"{date_format}\\""'
                     ]
-                
-                for cmd in date_commands:
-                    try:
-                        result = subprocess.run([
-                            adb_path, '-s', device, 'shell', cmd
-                        ], capture_output=True, text=True, timeout=12)
-                        
-                        if result.returncode == 0 and "invalid" not in result.stderr.lower():
-                            # Verify the date was set correctly
-                            time.sleep(1)
-                            verify = subprocess.run([
-                                adb_path, '-s', device, 'shell', 'date'
-                            ], capture_output=True, text=True, timeout=8)
-                            
-                            if verify.returncode == 0:
-                                current_date = verify.stdout.strip()
-                                # Check if the year matches what we wanted to set
-                                if str(date_obj.year) in current_date:
-                                    return f"✅ {device}: Date set successfully - {current_date}"
-                        
-                    except subprocess.TimeoutExpired:
-                        continue
-                    except:
-                        continue
+            
+            year_check = f'case "$(date)" in *{date_obj.year}*) ;; *) false;; esac'
+            composite = " || ".join(f"{{ {cmd} && {year_check}; }}" for cmd in date_commands) + "; date"
+            
+            try:
+                output, _ = session_shell(device, composite, adb_path, timeout=30)
+            except subprocess.TimeoutExpired:
+                return f"⏱️ {device}: Timeout while setting date"
+            
+            lines = [line.strip() for line in output.splitlines() if line.strip()]
+            current_date = lines[-1] if lines else ""
+            # Check if the year matches what we wanted to set
+            if str(date_obj.year) in current_date:
+                return f"✅ {device}: Date set successfully - {current_date}"
             
             return f"❌ {device}: Date setting failed with all methods"
             
         except Exception as e:
             return f"❌ {device}: Error - {str(e)[:50]}"
-        finally:
-            # Clean disconnect
-            try:
-                subprocess.run([adb_path, 'disconnect', device], 
-                              capture_output=True, timeout=5)
-            except:
-                pass
 
-    # Optimal parallelism for balance between speed and reliability
-    results = []
-    success_count = 0
-    
-    # Reduced to 5 parallel workers for more stable connections
-    with ThreadPoolExecutor(max_workers=min(5, len(devices))) as executor:
-        future_results = executor.map(set_date_on_device_reliable, devices)
-        
-        for result in future_results:
-            results.append(result)
-            if "✅" in result:
-                success_count += 1
+    # Results come back as devices finish; slow ones are cut off at the deadline
+    results = fan_out(set_date_on_device_reliable, devices, SET_DATE_DEADLINE,
+                      lambda device: f"⏱️ {device}: No result within {SET_DATE_DEADLINE}s")
+    success_count = sum(1 for result in results if "✅" in result)
     
     summary = f"📊 Date Setting Results: {success_count}/{len(devices)} successful\n\n" + "\n".join(results)
     return jsonify({'message': summary})
@@ -605,53 +1229,38 @@ def test_connections():
     devices = [ip.strip() for ip in data.get('devices', '').split('\n') if ip.strip()]
     adb_path = data.get('adb_path')
     
-    if not devices or not adb_path or not os.path.exists(adb_path):
+    if not devices or not adb_path or not valid_adb(adb_path):
         return jsonify({'message': 'Missing or invalid parameters'}), 400
     
+    ensure_server(adb_path)
+    
     def test_connection_reliable(device):
         try:
             start_time = time.time()
             
-            # Clean connection test
-            subprocess.run([adb_path, 'disconnect', device], 
-                          capture_output=True, timeout=5)
-            time.sleep(0.5)
-            
-            result = subprocess.run([
-                adb_path, 'connect', device
-            ], capture_output=True, text=True, timeout=10)
+            result = adb_server_call(adb_path, adb_proto.connect, device, timeout=10)
             
-            if "connected" in result.stdout or "already connected" in result.stdout:
-                time.sleep(1)
-                test = subprocess.run([
-                    adb_path, '-s', device, 'shell', 'echo "connection_test"'
-                ], capture_output=True, text=True, timeout=8)
+            if b"connected" in result:
+                wait_for_device_state(device, adb_path)
+                output, returncode = adb_shell(device, 'echo "connection_test"', adb_path, timeout=8)
                 
                 response_time = int((time.time() - start_time) * 1000)
                 
-                if test.returncode == 0 and "connection_test" in test.stdout:
+                if returncode == 0 and "connection_test" in output:
                     return f"✅ {device}: Connected ({response_time}ms)"
                 else:
                     return f"🔄 {device}: Connected but shell test failed ({response_time}ms)"
             else:
-                return f"❌ {device}: Connection failed - {result.stdout.strip()}"
+                return f"❌ {device}: Connection failed - {result.decode('utf-8', 'replace').strip()}"
                 
         except subprocess.TimeoutExpired:
             return f"⏱️ {device}: Timeout"
         except Exception as e:
             return f"❌ {device}: Error - {str(e)[:30]}"
     
-    results = []
-    connected_count = 0
-    
-    # Balanced parallel testing
-    with ThreadPoolExecutor(max_workers=min(8, len(devices))) as executor:
-        future_results = executor.map(test_connection_reliable, devices)
-        
-        for result in future_results:
-            results.append(result)
-            if "✅" in result or "🔄" in result:
-                connected_count += 1
+    results = fan_out(test_connection_reliable, devices, TEST_CONNECTIONS_DEADLINE,
+                      lambda device: f"⏱️ {device}: No result within {TEST_CONNECTIONS_DEADLINE}s")
+    connected_count = sum(1 for result in results if "✅" in result or "🔄" in result)
     
     total_devices = len(devices)
     summary = f"📊 Connection Test: {connected_count}/{total_devices} connected\n\n" + "\n".join(results)
@@ -664,43 +1273,84 @@ def test_connections():
 
 @app.route('/device_info', methods=['POST'])
 def get_device_info():
-    """Get device information reliably"""
+    """Get device information reliably
+
+    Deprecated: /device_probe returns device info together with root status.
+    """
     data = request.json
     devices = [ip.strip() for ip in data.get('devices', '').split('\n') if ip.strip()]
     adb_path = data.get('adb_path')
     
-    if not devices or not adb_path or not os.path.exists(adb_path):
+    if not devices or not adb_path or not valid_adb(adb_path):
         return jsonify({'message': 'Missing or invalid parameters'}), 400
     
+    ensure_server(adb_path)
+    
     def get_single_device_info(device):
         try:
             if not ensure_reliable_connection(device, adb_path):
                 return f"❌ {device}: Connection failed"
             
-            # Get device model and Android version
-            model_result = subprocess.run([
-                adb_path, '-s', device, 'shell', 'getprop ro.product.model'
-            ], capture_output=True, text=True, timeout=8)
-            
-            version_result = subprocess.run([
-                adb_path, '-s', device, 'shell', 'getprop ro.build.version.release'
-            ], capture_output=True, text=True, timeout=8)
+            # Get device model and Android version in one round trip
+            output, returncode = session_shell(device, 
+                'getprop ro.product.model; getprop ro.build.version.release', adb_path, timeout=8)
             
-            model = model_result.stdout.strip() if model_result.returncode == 0 else "Unknown"
-            version = version_result.stdout.strip() if version_result.returncode == 0 else "Unknown"
+            if returncode == 0:
+                model, version = (output.split('\n') + ['', ''])[:2]
+                model, version = model.strip(), version.strip()
+            else:
+                model, version = "Unknown", "Unknown"
             
             return f"📱 {device}: {model} (Android {version})"
             
         except Exception as e:
             return f"❌ {device}: Error - {str(e)[:30]}"
     
-    # Get device info with balanced parallelism
-    with ThreadPoolExecutor(max_workers=min(5, len(devices))) as executor:
+    with ThreadPoolExecutor(max_workers=fanout_workers(devices)) as executor:
         results = list(executor.map(get_single_device_info, devices))
     
     summary = "📱 Device Information:\n\n" + "\n".join(results)
     return jsonify({'message': summary})
 
+@app.route('/device_probe', methods=['POST'])
+def device_probe():
+    """Connection, root status and device info with one shell round trip per device"""
+    data = request.json
+    devices = [ip.strip() for ip in data.get('devices', '').split('\n') if ip.strip()]
+    adb_path = data.get('adb_path')
+    
+    if not devices or not adb_path or not valid_adb(adb_path):
+        return jsonify({'message': 'Missing or invalid parameters'}), 400
+    
+    ensure_server(adb_path)
+    
+    with ThreadPoolExecutor(max_workers=fanout_workers(devices)) as executor:
+        probes = list(executor.map(lambda device: probe_device(device, adb_path), devices))
+    
+    results = []
+    for probe in probes:
+        if probe['error']:
+            results.append(f"❌ {probe['device']}: {probe['error']}")
+            continue
+        if probe['rooted']:
+            root_text = f"🔓 rooted ({probe['su_format']})" if probe['su_format'] else "🔓 rooted (su binary found)"
+        else:
+            root_text = "🔒 not rooted"
+        results.append(f"📱 {probe['device']}: {probe['model']} (Android {probe['version']}) - {root_text}")
+    
+    connected_count = sum(1 for probe in probes if probe['connected'])
+    rooted_count = sum(1 for probe in probes if probe['rooted'])
+    summary = (f"📊 Device Probe: {connected_count}/{len(devices)} connected, "
+               f"{rooted_count}/{len(devices)} rooted\n\n" + "\n".join(results))
+    
+    return jsonify({
+        'message': summary,
+        'devices': probes,
+        'connected_count': connected_count,
+        'rooted_count': rooted_count,
+        'total_count': len(devices)
+    })
+
 if __name__ == '__main__':
     print("Starting APK Installer Server...")
     print("Ultra-Conservative Timeouts Mode: Long timeouts for maximum reliability")
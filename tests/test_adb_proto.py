@@ -0,0 +1,185 @@
+"""adb_proto against an in-process fake of the local ADB server"""
+import os
+import socketserver
+import subprocess
+import threading
+import unittest
+
+import adb_proto
+
+SERIAL = '192.168.1.10:5555'
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+    """Just enough of the ADB server to open device streams
+
+    Like the real server, whatever arrived in the same read as
+    host:transport is dropped when the transport is switched.
+    """
+    # Whether the device knows shell,raw: (adbd with shell v2)
+    raw_shell = True
+    shell_env = None
+
+    def handle(self):
+        self.buffer = b''
+        try:
+            request = self.read_request()
+            if request != f'host:transport:{SERIAL}':
+                return self.fail('unknown host service')
+            self.request.sendall(b'OKAY')
+            self.buffer = b''
+            service = self.read_request()
+        except EOFError:
+            return
+        self.server.services.append(service)
+        if service == 'shell,raw:' and self.raw_shell:
+            self.request.sendall(b'OKAY')
+            self.interactive_shell(pty=False)
+        elif service == 'shell:':
+            self.request.sendall(b'OKAY')
+            self.interactive_shell(pty=True)
+        elif service.startswith('shell:'):
+            self.request.sendall(b'OKAY')
+            result = subprocess.run(['sh', '-c', service[6:]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.request.sendall(result.stdout)
+        else:
+            self.fail('unknown service')
+
+    def interactive_shell(self, pty):
+        """Bridge the stream to sh, on a pty like adbd's plain shell: or on pipes"""
+        if pty:
+            import pty as pty_module
+            master, slave = pty_module.openpty()
+            proc = subprocess.Popen(['/bin/sh', '-i'], stdin=slave, stdout=slave, stderr=slave,
+                                    env=self.shell_env, start_new_session=True)
+            os.close(slave)
+            read_fd, write_fd = master, master
+        else:
+            proc = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, env=self.shell_env)
+            read_fd, write_fd = proc.stdout.fileno(), proc.stdin.fileno()
+
+        def pump():
+            while True:
+                try:
+                    data = os.read(read_fd, 65536)
+                except OSError:
+                    break
+                if not data:
+                    break
+                self.request.sendall(data)
+
+        threading.Thread(target=pump, daemon=True).start()
+        try:
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    break
+                os.write(write_fd, data)
+        finally:
+            proc.kill()
+            proc.wait()
+            if pty:
+                os.close(master)
+            else:
+                proc.stdin.close()
+                proc.stdout.close()
+
+    def read_request(self):
+        while len(self.buffer) < 4 or len(self.buffer) < 4 + int(self.buffer[:4], 16):
+            chunk = self.request.recv(65536)
+            if not chunk:
+                raise EOFError
+            self.buffer += chunk
+        length = int(self.buffer[:4], 16)
+        request = self.buffer[4:4 + length].decode('utf-8')
+        self.buffer = self.buffer[4 + length:]
+        return request
+
+    def fail(self, message):
+        self.request.sendall(b'FAIL%04x' % len(message) + message.encode('utf-8'))
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler):
+        super().__init__(address, handler)
+        # Device services requested, in order
+        self.services = []
+
+
+class FakeServerTestCase(unittest.TestCase):
+    handler = FakeAdbHandler
+
+    def setUp(self):
+        self.server = FakeAdbServer(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        port = adb_proto.ADB_PORT
+        adb_proto.ADB_PORT = self.server.server_address[1]
+        self.addCleanup(setattr, adb_proto, 'ADB_PORT', port)
+
+
+class OpenServiceTest(FakeServerTestCase):
+
+    def test_service_request_waits_for_transport(self):
+        self.assertEqual(adb_proto.shell(SERIAL, 'echo hello', timeout=2), ('hello\n', 0))
+
+    def test_exit_status(self):
+        self.assertEqual(adb_proto.shell(SERIAL, '(exit 3)', timeout=2), ('', 3))
+
+    def test_unknown_service_fails(self):
+        with self.assertRaises(adb_proto.AdbError):
+            adb_proto.open_service(SERIAL, 'sync:', timeout=2)
+
+
+
+class LegacyAdbHandler(FakeAdbHandler):
+    """Device without shell v2: only shell:, always on a pty"""
+    raw_shell = False
+
+
+class NoSttyAdbHandler(LegacyAdbHandler):
+    """Legacy device whose shell cannot find stty"""
+    shell_env = {'PATH': '/nonexistent'}
+
+
+class SessionTestCase(FakeServerTestCase):
+
+    def assertSessionKept(self):
+        shell = adb_proto.PersistentShell(SERIAL, timeout=5)
+        self.addCleanup(shell.close)
+        first, rc = shell.run('echo $$', timeout=5)
+        self.assertEqual(rc, 0)
+        self.assertRegex(first, r'^\d+\n$')
+        self.assertEqual(shell.run('echo $$', timeout=5), (first, 0))
+        self.assertEqual(shell.run('echo out; echo err >&2; false', timeout=5), ('out\nerr\n', 1))
+
+
+class PersistentShellTest(SessionTestCase):
+
+    def test_raw_shell_is_kept(self):
+        self.assertSessionKept()
+
+
+@unittest.skipUnless(os.name == 'posix', "needs a pty")
+class LegacyPersistentShellTest(SessionTestCase):
+    handler = LegacyAdbHandler
+
+    def test_pty_shell_is_kept_without_echo(self):
+        self.assertSessionKept()
+
+
+@unittest.skipUnless(os.name == 'posix', "needs a pty")
+class EchoingPersistentShellTest(FakeServerTestCase):
+    handler = NoSttyAdbHandler
+
+    def test_echoing_shell_is_refused(self):
+        with self.assertRaises(adb_proto.ShellEchoError):
+            adb_proto.PersistentShell(SERIAL, timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+"""Per-device shell sessions in app.py against the fake ADB server"""
+import unittest
+
+import app
+from tests.test_adb_proto import SERIAL, FakeServerTestCase
+
+ADB_PATH = '/nonexistent/adb'
+
+
+class SessionShellTest(FakeServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(app.close_sessions)
+
+    def test_uninstall_and_launch_share_one_stream(self):
+        output, returncode = app.session_shell(SERIAL, 'echo Success', ADB_PATH)
+        self.assertEqual((output, returncode), ('Success\n', 0))
+        # No am/monkey here, so the launch chain fails, but it still runs on the session
+        self.assertEqual(app.launch_app_fast(SERIAL, 'com.example', ADB_PATH), (False, "Launch failed"))
+        self.assertEqual(app.session_shell(SERIAL, 'echo done', ADB_PATH), ('done\n', 0))
+        self.assertEqual(self.server.services, ['shell,raw:'])
+        self.assertFalse(app.connection_entry(SERIAL)['one_shot'])
+
+
+if __name__ == '__main__':
+    unittest.main()